@@ -3,133 +3,275 @@ import os
 import io
 import csv
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from langchain_core.tools import tool
+import math
+import functools
+import itertools
+import hashlib
+from diskcache import Cache
+from langchain_core.tools import InjectedToolArg, tool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+import numpy as np
+import pandas as pd
 import pathway as pw
-from typing import Any
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from numba import njit
+from typing import Annotated, Any
 load_dotenv()
 
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 gemini_endpoint = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
 
+# Keep this the only client: its gRPC (HTTP/2) channel is opened once and multiplexes every ainvoke.
 llm = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash",
     api_key=os.getenv("GEMINI_API_KEY"),
     temperature=0.7
 )
 
+agent_cache = Cache("./.agent_cache")
+AGENT_CACHE_TTL = 24 * 60 * 60
+
+def _content_key(*parts: str) -> str:
+    """Returns a BLAKE2b content hash of the given strings."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
 def _get_string_content(content: Any) -> str:
     """Safely extracts string content from a LangChain message."""
-    if isinstance(content, str):
+    if type(content) is str:
         return content
-    if isinstance(content, list):
-        text_content = ""
-        for part in content:
-            if isinstance(part, dict) and part.get("type") == "text":
-                text_content = part.get("text", "")
-                break
-            elif isinstance(part, str):
-                text_content = part
-                break
-        return text_content
+    if type(content) is list:
+        return next(
+            (
+                part.get("text", "") if isinstance(part, dict) else part
+                for part in content
+                if isinstance(part, str) or (isinstance(part, dict) and part.get("type") == "text")
+            ),
+            ""
+        )
     return str(content)
 
-@tool
-def analyze_csv_data(csv_text: str, query: str) -> str:
-    """
-    Analyzes CSV data and extracts key statistics or insights based on the query.
-
-    Args:
-        csv_text: The CSV data as a string.
-        query: The analysis query (e.g., "summary", "describe columns", "find trends").
-
-    Returns:
-        A text summary of the analysis.
-    """
-    import io, csv, statistics
-
-    if not csv_text.strip():
-        return "Error: CSV data is empty."
-
-    f = io.StringIO(csv_text)
-    reader = csv.DictReader(f)
-    rows = list(reader)
-    headers = reader.fieldnames or []
-
-    if not rows or not headers:
+@njit(cache=True)
+def _col_stats(a):
+    """Single-pass mean, min, max and population std dev of a float64 array (Welford's update)."""
+    n = a.shape[0]
+    mean = 0.0
+    m2 = 0.0
+    mn = a[0]
+    mx = a[0]
+    for i in range(n):
+        v = a[i]
+        delta = v - mean
+        mean += delta / (i + 1)
+        m2 += delta * (v - mean)
+        if v < mn:
+            mn = v
+        if v > mx:
+            mx = v
+    return mean, mn, mx, math.sqrt(m2 / n)
+
+@functools.lru_cache(maxsize=64)
+def _header_lookup(headers: tuple) -> dict:
+    """Maps lowercased header names to the original names, first occurrence wins."""
+    lc_to_orig = {}
+    for h in headers:
+        lc_to_orig.setdefault(h.lower(), h)
+    return lc_to_orig
+
+_tables = {}
+
+def _dedupe_names(names: list) -> list:
+    """Renames repeated headers the way pandas does: Score, Score.1, Score.2."""
+    counts = {}
+    out = []
+    for name in names:
+        cur = counts.get(name, 0)
+        while cur > 0:
+            counts[name] = cur + 1
+            name = f"{name}.{cur}"
+            cur = counts.get(name, 0)
+        out.append(name)
+        counts[name] = cur + 1
+    return out
+
+def _read_header(csv_text: str) -> tuple:
+    """Returns the first non-empty row as de-duplicated names and the physical lines it ends on."""
+    lines_read = 0
+
+    def _lines():
+        nonlocal lines_read
+        for line in io.StringIO(csv_text.lstrip('\ufeff'), newline=''):
+            lines_read += 1
+            yield line
+
+    for row in csv.reader(_lines()):
+        if row:
+            return _dedupe_names(row), lines_read
+    return [], lines_read
+
+def _read_ragged_csv(csv_text: str, names: list, skip_rows: int) -> pa.Table:
+    """Slow path for rows with the wrong field count: pads short rows with nulls, truncates long ones."""
+    width = len(names)
+    columns = [[] for _ in names]
+    lines = io.StringIO(csv_text.lstrip('\ufeff'), newline='')
+    for row in csv.reader(itertools.islice(lines, skip_rows, None)):
+        if not row:
+            continue
+        row = row[:width] + [""] * (width - len(row))
+        for column, cell in zip(columns, row):
+            column.append(cell if cell != "" else None)
+    return pa.Table.from_arrays([pa.array(c, type=pa.string()) for c in columns], names=names)
+
+def _open_table(csv_text: str) -> str:
+    """Registers CSV text for an agent run and returns its content-hash table handle."""
+    table_handle = _content_key(csv_text)
+    entry = _tables.setdefault(table_handle, {"csv_text": csv_text, "table": None, "refs": 0})
+    entry["refs"] += 1
+    return table_handle
+
+def _get_table(table_handle: str) -> pa.Table:
+    """Returns the columnar table for a handle, parsing the CSV on first use."""
+    entry = _tables.get(table_handle)
+    if entry is None:
+        raise ValueError(f"Unknown table handle '{table_handle}'")
+    if entry["table"] is None:
+        csv_text = entry["csv_text"]
+        # Keep every cell as its source text; tools decide per column what is numeric.
+        # Arrow gets the header from us so its schema and column_types always agree.
+        names, skip_rows = _read_header(csv_text)
+        ragged_rows = []
+
+        def _note_ragged_row(row):
+            ragged_rows.append(row.number)
+            return 'skip'
+
+        if not names:
+            table = pa.table({})
+        else:
+            table = pacsv.read_csv(
+                pa.BufferReader(csv_text.encode()),
+                read_options=pacsv.ReadOptions(column_names=names, skip_rows=skip_rows),
+                parse_options=pacsv.ParseOptions(invalid_row_handler=_note_ragged_row),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={h: pa.string() for h in names},
+                    null_values=[""],
+                    strings_can_be_null=True
+                )
+            )
+        if ragged_rows:
+            table = _read_ragged_csv(csv_text, names, skip_rows)
+        entry["ragged_rows"] = len(ragged_rows)
+        entry["table"] = table
+    return entry["table"]
+
+def _close_table(table_handle: str) -> None:
+    """Releases a handle from _open_table, dropping the table once no run uses it."""
+    entry = _tables[table_handle]
+    entry["refs"] -= 1
+    if entry["refs"] == 0:
+        del _tables[table_handle]
+
+@functools.lru_cache(maxsize=32)
+def _analyze_csv(table_handle: str, query: str) -> str:
+    """Cached body of analyze_csv_data; handles are content hashes, so hits are always valid."""
+    df = _get_table(table_handle).to_pandas()
+    headers = list(df.columns)
+
+    if df.empty or not headers:
         return "Error: Invalid or empty CSV data."
 
-    numeric_columns = {}
+    # Cells are read as text; sniff each column on a head sample for mostly-numeric data.
+    head = df.head(200)
+    numeric_cols = set()
     for h in headers:
-        col_values = []
-        for row in rows:
-            val = row.get(h, "").strip()
-            try:
-                col_values.append(float(val))
-            except ValueError:
-                continue
-        if len(col_values) > 0:
-            numeric_columns[h] = col_values
+        sample = head[h].dropna()
+        if len(sample) and pd.to_numeric(sample, errors='coerce').notna().mean() > 0.5:
+            numeric_cols.add(h)
+    num_df = (
+        df[[h for h in headers if h in numeric_cols]]
+        .apply(pd.to_numeric, errors='coerce')
+        .dropna(axis=1, how='all')
+    )
 
     query_lower = query.lower().strip()
 
     if "summary" in query_lower or "overview" in query_lower or query_lower == "":
         summary = [
-            f"CSV contains {len(rows)} rows and {len(headers)} columns.",
+            f"CSV contains {len(df)} rows and {len(headers)} columns.",
             f"Columns: {', '.join(headers)}.",
             "",
             "Numeric column statistics:"
         ]
-        for h, vals in numeric_columns.items():
+        if len(num_df.columns):
+            stats = num_df.describe().T
+            # describe() reports the sample std; rescale to the population value.
+            stats['std'] = (stats['std'] * np.sqrt((stats['count'] - 1) / stats['count'])).fillna(0.0)
+            for h, row in stats.iterrows():
+                summary.append(
+                    f"- {h}: mean={row['mean']:.2f}, "
+                    f"min={row['min']:.2f}, max={row['max']:.2f}, "
+                    f"std={row['std']:.2f}"
+                )
+        ragged_rows = _tables[table_handle]["ragged_rows"]
+        if ragged_rows:
             summary.append(
-                f"- {h}: mean={statistics.mean(vals):.2f}, "
-                f"min={min(vals):.2f}, max={max(vals):.2f}, "
-                f"std={statistics.pstdev(vals):.2f}"
+                f"\nNote: {ragged_rows} rows had the wrong number of fields; "
+                f"short rows were padded with empty cells and extra fields were dropped."
             )
         return "\n".join(summary)
 
-    for h in headers:
-        if h.lower() in query_lower:
-            vals = numeric_columns.get(h)
-            if vals:
-                return (
-                    f"Column '{h}' has {len(vals)} numeric values.\n"
-                    f"Mean: {statistics.mean(vals):.2f}\n"
-                    f"Min: {min(vals):.2f}\n"
-                    f"Max: {max(vals):.2f}\n"
-                    f"Std Dev: {statistics.pstdev(vals):.2f}"
-                )
-            else:
-                freq = {}
-                for row in rows:
-                    val = row.get(h, "").strip()
-                    if val:
-                        freq[val] = freq.get(val, 0) + 1
-                top_vals = sorted(freq.items(), key=lambda x: x[1], reverse=True)[:5]
-                return (
-                    f"Column '{h}' appears to be categorical.\n"
-                    f"Top values:\n" +
-                    "\n".join([f"- {v}: {c} occurrences" for v, c in top_vals])
-                )
+    lc_to_orig = _header_lookup(tuple(headers))
+    h = lc_to_orig.get(query_lower)
+    if h is None:
+        h = next((orig for lc, orig in lc_to_orig.items() if lc in query_lower), None)
+    if h is not None:
+        if h in num_df:
+            vals = num_df[h].dropna().to_numpy(dtype=np.float64)
+            mean, mn, mx, std = _col_stats(vals)
+            return (
+                f"Column '{h}' has {len(vals)} numeric values.\n"
+                f"Mean: {mean:.2f}\n"
+                f"Min: {mn:.2f}\n"
+                f"Max: {mx:.2f}\n"
+                f"Std Dev: {std:.2f}"
+            )
+        else:
+            vals = df[h].dropna().astype(str).str.strip()
+            top_vals = vals[vals != ""].value_counts().head(5)
+            return (
+                f"Column '{h}' appears to be categorical.\n"
+                f"Top values:\n" +
+                "\n".join([f"- {v}: {c} occurrences" for v, c in top_vals.items()])
+            )
 
     if "correlation" in query_lower or "trend" in query_lower:
-        import numpy as np
-        corrs = []
+        numeric_columns = {h: num_df[h].dropna().to_numpy() for h in num_df.columns}
+        numeric_columns = {h: v for h, v in numeric_columns.items() if len(v) >= 2}
         cols = list(numeric_columns.keys())
-        for i in range(len(cols)):
-            for j in range(i + 1, len(cols)):
-                a, b = numeric_columns[cols[i]], numeric_columns[cols[j]]
-                n = min(len(a), len(b))
-                if n < 2:
-                    continue
-                corr = np.corrcoef(a[:n], b[:n])[0, 1]
-                corrs.append((cols[i], cols[j], corr))
-        if not corrs:
+        if len(cols) < 2:
             return "No numeric correlations found."
-        corrs.sort(key=lambda x: abs(x[2]), reverse=True)
-        top_corrs = "\n".join([f"- {a} ↔ {b}: corr={c:.2f}" for a, b, c in corrs[:5]])
+        # Each pair is cut to its own common length, so one corrcoef call per distinct length.
+        lengths = np.array([len(v) for v in numeric_columns.values()])
+        pair_lengths = np.minimum.outer(lengths, lengths)
+        corr_matrix = np.full((len(cols), len(cols)), np.nan)
+        for n in np.unique(lengths):
+            idx = np.flatnonzero(lengths >= n)
+            if len(idx) < 2:
+                continue
+            block = np.ix_(idx, idx)
+            sub = np.corrcoef(np.vstack([numeric_columns[cols[i]][:n] for i in idx]))
+            corr_matrix[block] = np.where(pair_lengths[block] == n, sub, corr_matrix[block])
+        iu = np.triu_indices_from(corr_matrix, k=1)
+        corrs = corr_matrix[iu]
+        top = sorted(range(len(corrs)), key=lambda k: abs(corrs[k]), reverse=True)[:5]
+        top_corrs = "\n".join([f"- {cols[iu[0][k]]} ↔ {cols[iu[1][k]]}: corr={corrs[k]:.2f}" for k in top])
         return f"Top correlations:\n{top_corrs}"
 
     return (
@@ -138,12 +280,35 @@ def analyze_csv_data(csv_text: str, query: str) -> str:
     )
 
 @tool
-def filter_data(csv_text: str, column_name: str, operator: str, value: str) -> str:
+def analyze_csv_data(table_handle: Annotated[str, InjectedToolArg], query: str) -> str:
+    """
+    Analyzes CSV data and extracts key statistics or insights based on the query.
+
+    Args:
+        query: The analysis query (e.g., "summary", "describe columns", "find trends").
+
+    Returns:
+        A text summary of the analysis.
+    """
+    return _analyze_csv(table_handle, query)
+
+_NUMBER_PATTERN = r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$'
+
+_FILTER_OPS = {
+    '==': pc.equal,
+    '!=': pc.not_equal,
+    '>': pc.greater,
+    '<': pc.less,
+    '>=': pc.greater_equal,
+    '<=': pc.less_equal,
+}
+
+@tool
+def filter_data(table_handle: Annotated[str, InjectedToolArg], column_name: str, operator: str, value: str) -> str:
     """
     Filters CSV data based on a condition.
     
     Args:
-        csv_text: The CSV data as a string
         column_name: Column to filter on
         operator: Filtering operator (e.g., '==', '!=', '>', '<', '>=', '<=')
         value: The value to compare against (will be string-compared or float-compared if possible)
@@ -152,94 +317,66 @@ def filter_data(csv_text: str, column_name: str, operator: str, value: str) -> s
         Filtered CSV data as a string, including headers, or an error message.
     """
     try:
-        f = io.StringIO(csv_text)
-        reader = csv.reader(f)
-        lines = list(reader)
-        
-        if not lines:
-            return "Error: CSV data is empty."
-            
-        headers = lines[0]
-        
-        try:
-            col_index = headers.index(column_name)
-        except ValueError:
+        table = _get_table(table_handle)
+        headers = table.column_names
+
+        if column_name not in headers:
             return f"Error: Column '{column_name}' not found. Available columns: {', '.join(headers)}"
 
-        try_numeric = True
+        if operator not in _FILTER_OPS:
+            return f"Error: Invalid operator '{operator}'. Use one of: {', '.join(_FILTER_OPS.keys())}"
+        
+        op_func = _FILTER_OPS[operator]
+        column = table[column_name]
+
         try:
             compare_value = float(value)
         except ValueError:
-            try_numeric = False
-            compare_value = value
-
-        op_map = {
-            '==': lambda a, b: a == b,
-            '!=': lambda a, b: a != b,
-            '>': lambda a, b: a > b,
-            '<': lambda a, b: a < b,
-            '>=': lambda a, b: a >= b,
-            '<=': lambda a, b: a <= b,
-        }
-        
-        if operator not in op_map:
-            return f"Error: Invalid operator '{operator}'. Use one of: {', '.join(op_map.keys())}"
-        
-        op_func = op_map[operator]
-        
-        filtered_rows = [headers]
-        for row in lines[1:]:
-            if len(row) <= col_index:
-                continue
-                
-            cell_value_str = row[col_index]
-            
-            try:
-                if try_numeric:
-                    cell_value = float(cell_value_str)
-                else:
-                    cell_value = cell_value_str
-                
-                if op_func(cell_value, compare_value):
-                    filtered_rows.append(row)
-                    
-            except (ValueError, TypeError):
-                if not try_numeric and op_func(cell_value_str, compare_value):
-                     filtered_rows.append(row)
-                
-        if len(filtered_rows) == 1:
+            compare_value = None
+
+        if compare_value is not None:
+            # Cells that are not numbers become null and are dropped.
+            text = pc.utf8_trim_whitespace(column)
+            is_number = pc.match_substring_regex(text, _NUMBER_PATTERN)
+            numbers = pc.cast(pc.if_else(is_number, text, pa.scalar(None, pa.string())), pa.float64())
+            mask = op_func(numbers, pa.scalar(compare_value))
+        else:
+            mask = op_func(pc.fill_null(column, ""), pa.scalar(value))
+
+        filtered = table.filter(mask)
+        if filtered.num_rows == 0:
             return f"Filtered data for {column_name} {operator} {value}: No matching rows found."
 
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerows(filtered_rows)
-        return output.getvalue().strip()
+        sink = io.BytesIO()
+        pacsv.write_csv(filtered, sink)
+        return sink.getvalue().decode().strip()
 
     except Exception as e:
         return f"Error during filtering: {str(e)}"
 
 tools = [analyze_csv_data, filter_data]
-llm_with_tools = llm.bind_tools(tools)
+# Bind OpenAI-style dicts: unlike the Gemini BaseTool converter, they omit InjectedToolArg parameters.
+llm_with_tools = llm.bind_tools([convert_to_openai_tool(t) for t in tools])
+
+_TOOLS_DICT = {
+    "analyze_csv_data": analyze_csv_data,
+    "filter_data": filter_data
+}
 
-def process_tool_calls(tool_calls: list, csv_data: str) -> list:
+async def process_tool_calls(tool_calls: list, table_handle: str) -> list:
     """Execute tool calls and return results."""
     results = []
     
-    tools_dict = {
-        "analyze_csv_data": analyze_csv_data,
-        "filter_data": filter_data
-    }
-    
     for tool_call in tool_calls:
         tool_name = tool_call["name"]
         tool_args = tool_call["args"]
 
-        if tool_name in tools_dict:
-            tool_args["csv_text"] = csv_data
+        if tool_name in _TOOLS_DICT:
+            tool_args["table_handle"] = table_handle
         
         try:
-            tool_func = tools_dict[tool_name]
-            result = tool_func.invoke(tool_args)
+            tool_func = _TOOLS_DICT[tool_name]
+            result = await tool_func.ainvoke(tool_args)
             results.append({
                 "tool_call_id": tool_call.get("id"),
                 "name": tool_name,
@@ -254,19 +391,22 @@ def process_tool_calls(tool_calls: list, csv_data: str) -> list:
     
     return results
 
-def run_agentic_loop(user_query: str, csv_data: str, max_iterations: int = 5):
+async def arun_agentic_loop(user_query: str, csv_data: str, table_handle: str, max_iterations: int = 5):
     """
     Main agentic loop that implements ReAct pattern.
     
     The loop continues until:
     1. Model returns a final answer (no tool calls)
     2. Max iterations reached
+
+    Tools receive table_handle (see _open_table) instead of a fresh copy of csv_data.
+
+    Returns (content, is_final); is_final is False for the max-iterations fallback.
     """
     print(f"\n{'='*60}")
     print(f"User Query: {user_query}")
     print(f"{'='*60}\n")
-    initial_prompt = f"{user_query}\n\nHere is the CSV data to analyze:\n\n{csv_data}"
-    messages = [HumanMessage(content=initial_prompt)]
+    messages = [HumanMessage(content=user_query), HumanMessage(content=csv_data)]
     
     iteration = 0
     
@@ -274,13 +414,13 @@ def run_agentic_loop(user_query: str, csv_data: str, max_iterations: int = 5):
         iteration += 1
         print(f"--- Iteration {iteration} ---")
         
-        response = llm_with_tools.invoke(messages)
+        response = await llm_with_tools.ainvoke(messages)
         
         if hasattr(response, 'tool_calls') and response.tool_calls:
             print(f"Thought: Model decided to use tools")
             print(f"Tool calls: {[tc['name'] for tc in response.tool_calls]}\n")
             
-            tool_results = process_tool_calls(response.tool_calls, csv_data)
+            tool_results = await process_tool_calls(response.tool_calls, table_handle)
             
             messages.append(response)
             
@@ -296,19 +436,14 @@ def run_agentic_loop(user_query: str, csv_data: str, max_iterations: int = 5):
         else:
             final_content = _get_string_content(response.content)
             print(f"Final Answer: {final_content}")
-            return final_content
+            return final_content, True
     
     print(f"Max iterations ({max_iterations}) reached")
     
     if messages:
         last_content = _get_string_content(messages[-1].content)
-        return last_content
-    return "No response"
-
-class InputSchema(pw.Schema):
-    name: str
-    value: int
-    timestamp: str
+        return last_content, False
+    return "No response", False
 
 gdrive_table = pw.io.gdrive.read(
     object_id="19DMQzidCyVGkXVUUyJM8j4jtgCSgRr9D", ## Replace this with your Folder ID
@@ -316,36 +451,21 @@ gdrive_table = pw.io.gdrive.read(
     mode="streaming"
 )
 
-@pw.udf
+@pw.udf(deterministic=True)
 def decode_bytes_to_text(data: bytes) -> str:
-    try:
-        return data.decode('utf-8')
-    except Exception as e:
-        print(f"Decode error: {e}")
-        return ""
+    return data.decode('utf-8', 'replace')
 
 decoded_csv_table = gdrive_table.select(
     decoded_text = decode_bytes_to_text(gdrive_table.data)
 )
 
-executor = ThreadPoolExecutor(max_workers=4)
-
-@pw.udf(executor=pw.udfs.async_executor(capacity=2, timeout=3000.0))
-async def process_with_agent(csv_text: str) -> str:
-    """Process CSV using the agentic system with proper async handling."""
-    if not csv_text.strip():
-        return ""
-    
-    user_query = f"""You are a data analyst. Analyze the following CSV data and provide CONCRETE insights. 
+SYSTEM_PROMPT = """You are a data analyst. Analyze the CSV data given in the next message and provide CONCRETE insights. 
 
 DO NOT ask for clarification. DO NOT ask what kind of analysis. Just analyze and report.
 
 Use the available tools to analyze this CSV data.
 First, call analyze_csv_data to get a summary, then use filter_data if needed, then carry out further analysis if you wish.
 
-CSV Data:
-{csv_text}
-
 Provide your analysis in this format:
 1. SUMMARY: Basic statistics (row count, columns)
 2. GRADE DISTRIBUTION: Average, min, max, and standard deviation for each grading component
@@ -355,14 +475,27 @@ Provide your analysis in this format:
 6. RECOMMENDATIONS: Key observations for instructors
 
 Be specific - use actual numbers and student statistics from the data."""
+
+@pw.udf(executor=pw.udfs.async_executor(capacity=2, timeout=3000.0))
+async def process_with_agent(csv_text: str) -> str:
+    """Process CSV using the agentic system with proper async handling."""
+    if not csv_text.strip():
+        return ""
     
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(
-        executor,
-        run_agentic_loop, 
-        user_query, 
-        csv_text
-    )
+    # diskcache does blocking SQLite I/O; keep it off Pathway's UDF event loop.
+    key = _content_key(SYSTEM_PROMPT, csv_text)
+    cached = await asyncio.to_thread(agent_cache.get, key)
+    if cached is not None:
+        print(f"Cache hit for CSV {key}, skipping agent run")
+        return cached
+
+    table_handle = _open_table(csv_text)
+    try:
+        result, is_final = await arun_agentic_loop(SYSTEM_PROMPT, csv_text, table_handle)
+    finally:
+        _close_table(table_handle)
+    if is_final:
+        await asyncio.to_thread(agent_cache.set, key, result, expire=AGENT_CACHE_TTL)
     return result
 
 result_table = decoded_csv_table.select(